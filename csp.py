@@ -1,6 +1,112 @@
-import copy
 import time
 import itertools
+from array import array
+from collections import deque
+from enum import Enum
+
+try:
+    import numpy as np
+except ImportError:
+    # NumPy is optional; without it the kernel data falls back to
+    # typed arrays from the standard library array module
+    np = None
+
+try:
+    from numba import njit
+except ImportError:
+    # Numba is optional; without it the kernel below runs as plain Python
+    njit = None
+
+
+# Maximum number of search states remembered by the backtrack memo
+# cache, to bound its memory use
+MEMO_LIMIT = 100000
+
+# The shared value ordering of every Sudoku cell
+SUDOKU_DIGITS = ['1', '2', '3', '4', '5', '6', '7', '8', '9']
+
+
+class ConstraintKind(Enum):
+    # Arbitrary constraint, represented as a set of legal index pairs
+    GENERIC = 0
+    # Inequality constraint between variables with identical domains,
+    # handled analytically with bitwise operations
+    NEQ = 1
+
+
+def bit_indices(mask):
+    """
+    Yield the indices of the set bits in mask, i.e. the indices into a
+    variable's value list that are still legal.
+    """
+    while mask:
+        bit = mask & -mask
+        yield bit.bit_length() - 1
+        mask ^= bit
+
+
+def ac3_neq(domains, neighbors_ptr, neighbors_idx, start):
+    """
+    AC-3 kernel specialized for CSPs where every arc is a NEQ
+    constraint. domains is a flat sequence of domain bitmasks indexed
+    by variable id, and neighbors_ptr/neighbors_idx describe the
+    constraint graph in compressed sparse row form: the neighbors of
+    variable i are neighbors_idx[neighbors_ptr[i]:neighbors_ptr[i+1]].
+
+    For NEQ arcs, only a variable that is down to a single value can
+    narrow its neighbors, so the queue holds decided variable ids
+    rather than arcs. start is the id of a newly decided variable to
+    propagate from, or -1 to propagate from every decided variable
+    (the initial pass). The domains are revised in place. Returns True
+    unless some domain is wiped out.
+    """
+    num_variables = len(neighbors_ptr) - 1
+
+    # A variable becomes decided at most once, so a flat array of ids
+    # is large enough to hold the whole queue
+    queue = [0] * num_variables
+    head = 0
+    tail = 0
+
+    if start >= 0:
+        queue[tail] = start
+        tail += 1
+    else:
+        for i in range(num_variables):
+            domain = domains[i]
+            if domain != 0 and domain & (domain - 1) == 0:
+                queue[tail] = i
+                tail += 1
+
+    while head < tail:
+        j = queue[head]
+        head += 1
+
+        # Mask the decided variable's single value out of every neighbor
+        mask = ~domains[j]
+        for p in range(neighbors_ptr[j], neighbors_ptr[j + 1]):
+            i = neighbors_idx[p]
+            new_domain = domains[i] & mask
+
+            if new_domain != domains[i]:
+
+                # If there is no possible assignment for variable i
+                if new_domain == 0:
+                    return False
+
+                domains[i] = new_domain
+
+                # The neighbor is now decided, so propagate it in turn
+                if new_domain & (new_domain - 1) == 0:
+                    queue[tail] = i
+                    tail += 1
+
+    return True
+
+
+if njit is not None:
+    ac3_neq = njit(cache=True)(ac3_neq)
+
 
 class CSP:
 
@@ -8,13 +114,36 @@ class CSP:
         # List of the variable names in the CSP
         self.variables = []
 
-        # self.domains[i] is a list of legal values for variable i
+        # self.values[i] is the ordered list of possible values for
+        # variable i. Bit k of a domain mask refers to self.values[i][k]
+        self.values = {}
+
+        # self.domains[i] is an integer bitmask of the legal values for
+        # variable i, with bit k set if self.values[i][k] is still legal
         self.domains = {}
 
-        # self.constraints[i][j] is a list of legal value pairs for
+        # self.constraints[i][j] is a set of legal value index pairs for
         # the variable pair (i, j)
         self.constraints = {}
 
+        # self.constraint_kind[i][j] tells how the constraint between
+        # i and j should be evaluated (see ConstraintKind)
+        self.constraint_kind = {}
+
+        # Cached arc lists, built lazily by get_all_arcs and
+        # get_all_neighboring_arcs and invalidated whenever the
+        # constraint graph changes
+        self.all_arcs_cache = None
+        self.neighbor_arcs_cache = None
+
+        # Flat data for the ac3_neq kernel, built by backtracking_search
+        # when every arc is a NEQ constraint (None otherwise)
+        self.kernel_data = None
+
+        # Memo cache mapping a domain mask signature to the known
+        # outcome of searching from that state (None when disabled)
+        self.memo = None
+
 
     def add_variable(self, name, domain):
         """
@@ -22,15 +151,19 @@ class CSP:
         and domain is a list of the legal values for the variable.
         """
         self.variables.append(name)
-        self.domains[name] = list(domain)
+        self.values[name] = list(domain)
+        self.domains[name] = (1 << len(self.values[name])) - 1
         self.constraints[name] = {}
+        self.constraint_kind[name] = {}
 
 
     def get_all_possible_pairs(self, a, b):
         """
-        Get a list of all possible pairs (as tuples) of the values in
-        the lists a and b, where the first component comes from list
-        a and the second component comes from list b.
+        Get all possible pairs (as tuples) of the values in the
+        iterables a and b, where the first component comes from a and
+        the second component comes from b. Returns a single-use
+        iterator; it is only meant for constraint construction and
+        must not be called from the solver's hot path.
         """
         return itertools.product(a, b)
 
@@ -39,17 +172,24 @@ class CSP:
         """
         Get a list of all arcs/constraints that have been defined in
         the CSP. The arcs/constraints are represented as tuples (i, j),
-        indicating a constraint between variable i and j.
+        indicating a constraint between variable i and j. The list is
+        cached between calls, so it must not be mutated by the caller.
         """
-        return [(i, j) for i in self.constraints for j in self.constraints[i]]
+        if self.all_arcs_cache is None:
+            self.all_arcs_cache = [(i, j) for i in self.constraints for j in self.constraints[i]]
+        return self.all_arcs_cache
 
 
     def get_all_neighboring_arcs(self, var):
         """
-        Get a list of all arcs/constraints going to/from variable. The 
-        arcs/constraints are represented as in get_all_arcs().
+        Get a list of all arcs/constraints going to/from variable. The
+        arcs/constraints are represented as in get_all_arcs(). The lists
+        are cached between calls, so they must not be mutated by the caller.
         """
-        return [(i, var) for i in self.constraints[var]]
+        if self.neighbor_arcs_cache is None:
+            self.neighbor_arcs_cache = {v: [(i, v) for i in self.constraints[v]]
+                                        for v in self.variables}
+        return self.neighbor_arcs_cache[var]
 
 
     def add_constraint_one_way(self, i, j, filter_function):
@@ -61,20 +201,37 @@ class CSP:
         from i -> j.
         """
         if not j in self.constraints[i]:
-            # First, get a list of all possible pairs of values between variables i and j
-            self.constraints[i][j] = self.get_all_possible_pairs(self.domains[i], self.domains[j])
+            # First, get a list of all possible pairs of value indices between variables i and j
+            self.constraints[i][j] = self.get_all_possible_pairs(range(len(self.values[i])), range(len(self.values[j])))
+
+        # Filter such that only legal values remain. The pairs are kept
+        # in a set so that membership tests in backtrack and revise are O(1)
+        values_i = self.values[i]
+        values_j = self.values[j]
+        self.constraints[i][j] = {(x, y) for (x, y) in self.constraints[i][j]
+                                  if filter_function(values_i[x], values_j[y])}
+        self.constraint_kind[i][j] = ConstraintKind.GENERIC
 
-        # Filter such that only legal values remain
-        self.constraints[i][j] = list(filter(lambda value_pair: filter_function(*value_pair), self.constraints[i][j]))
+        # The constraint graph changed, so the cached arc lists are stale
+        self.all_arcs_cache = None
+        self.neighbor_arcs_cache = None
 
 
     def add_all_different_constraint(self, variables):
         """
-        Add an Alldiff constraint between all of the variables.
+        Add an Alldiff constraint between all of the variables. The
+        variables are assumed to list their possible values in the same
+        order, so that equal value indices mean equal values.
         """
-        for (i, j) in self.get_all_possible_pairs(variables, variables):
-            if i != j:
-                self.add_constraint_one_way(i, j, lambda x, y: x != y)
+        for (i, j) in itertools.permutations(variables, 2):
+            # NEQ arcs are evaluated analytically by revise and
+            # backtrack, so no set of legal pairs is materialized
+            self.constraints[i][j] = None
+            self.constraint_kind[i][j] = ConstraintKind.NEQ
+
+        # The constraint graph changed, so the cached arc lists are stale
+        self.all_arcs_cache = None
+        self.neighbor_arcs_cache = None
 
 
     def backtracking_search(self):
@@ -86,158 +243,322 @@ class CSP:
         global count_failures
         count_failures = 0
 
-        # Make a deep copy of the dictionary containing the
-        # domains of the CSP variables. The deep copy is required to
-        # ensure that any changes made to assignment does not have any
-        # side effects elsewhere.
-        assignment = copy.deepcopy(self.domains)
+        # Make a copy of the dictionary containing the domains of the
+        # CSP variables, to ensure that any changes made to assignment
+        # does not have any side effects elsewhere. A shallow copy is
+        # enough since the domain bitmasks are immutable integers.
+        assignment = self.domains.copy()
 
         # Run AC-3 on all constraints in the CSP, to weed out all of the
-        # values that are not arc consistent to begin with.
-        self.inference(assignment, self.get_all_arcs())
-        
-        return self.backtrack(assignment)
+        # values that are not arc consistent to begin with. This initial
+        # pass is never undone, so its trail is simply discarded.
+        self.kernel_data = self.build_kernel_data()
+        if self.kernel_data is not None:
+            self.kernel_inference(assignment, None, [])
+        else:
+            self.inference(assignment, deque(self.get_all_arcs()), [])
+
+        # Memoize search outcomes per domain signature, but only for
+        # NEQ-only CSPs where equal signatures mean equivalent subproblems
+        self.memo = {} if self.kernel_data is not None else None
+
+        # Count the variables that are already decided, so backtrack can
+        # keep the count incrementally instead of rescanning every call
+        num_decided = sum(1 for mask in assignment.values() if mask.bit_count() == 1)
+
+        result = self.backtrack(assignment, num_decided)
+        if not result:
+            return result
 
+        # Decode the domain bitmasks back into lists of values
+        return {name: [self.values[name][k] for k in bit_indices(mask)]
+                for name, mask in result.items()}
 
-    def backtrack(self, assignment):
+
+    def backtrack(self, assignment, num_decided):
         """Backtrack algorithm.
 
         The function is called recursively, with a partial assignment of
-        values in assignment. assignment is a dictionary that contains
-        a list of all legal values for the variables that have not yet
-        been decided, and a list of only a single value for the
-        variables that have been decided.
-
-        When all of the variables in assignment have lists of length
-        one, i.e. when all variables have been assigned a value, the
-        function should return assignment. Otherwise, the search continues. 
-        When the function inference is called to run the AC-3 algorithm, 
-        the lists of legal values in assignment is reduced as AC-3 
+        values in assignment. assignment is a dictionary that maps each
+        variable to a bitmask of its legal value indices, where a mask
+        with several bits set means the variable has not yet been
+        decided, and a mask with a single bit set means it has.
+        num_decided is the number of variables whose mask has a single
+        bit set, maintained incrementally by the callers.
+
+        When all of the variables in assignment have exactly one bit
+        set, i.e. when all variables have been assigned a value, the
+        function should return assignment. Otherwise, the search continues.
+        When the function inference is called to run the AC-3 algorithm,
+        the domain bitmasks in assignment is reduced as AC-3
         discovers illegal values.
         """
         global count_backtrack
         count_backtrack = count_backtrack + 1
 
-        # Check to see if all variables have been assigned a value
-        finished = True
-        for variable,values in assignment.items():
-            if len(values) != 1:
-                finished = False
-                break
-
         # Returning the assignment if its complete, i.e. all variables
         # have been assigned a single value
-        if finished:
+        if num_decided == len(self.variables):
             return assignment
 
+        # If an equivalent partial assignment has already been searched,
+        # reuse its outcome instead of re-expanding the subtree. The
+        # insertion order of assignment matches self.variables, so its
+        # values form a canonical signature of the search state
+        if self.memo is not None:
+            memo_key = tuple(assignment.values())
+            cached = self.memo.get(memo_key)
+            if cached is not None:
+                return cached
+
         variable = self.select_unassigned_variable(assignment)
         values = assignment[variable]
 
-        for value in values:
-          
-            # Check to see if the value is consistent with the partial assignment
+        # Try the least constraining values first, i.e. the values that
+        # are still legal in the fewest neighboring domains, since those
+        # leave the neighbors the most room
+        neighbors = self.constraints[variable]
+        ordered_values = sorted(bit_indices(values),
+                                key=lambda value: sum(1 for n in neighbors
+                                                      if assignment[n] & (1 << value)))
+
+        for value in ordered_values:
+            bit = 1 << value
+
+            # Forward checking: see if the value is consistent with every
+            # neighboring domain before paying for a full AC-3 pass. Most
+            # doomed trial values die right here
             consistent = True
-            for otherVariable in assignment:
-                if otherVariable != variable:
-                    if otherVariable in self.constraints[variable]:
-                        consistent = False
-                        all_pairs = self.get_all_possible_pairs([value],assignment[otherVariable])
-                        
-                        for pair in all_pairs:
-                            if pair in self.constraints[variable][otherVariable]:
-                                consistent = True
-                                break
-                    
-                    if not consistent:   
-                        break
-            
+            for otherVariable in self.constraints[variable]:
+                if self.constraint_kind[variable][otherVariable] is ConstraintKind.NEQ:
+                    # Consistent unless the neighbor is pinned to this very value
+                    consistent = assignment[otherVariable] & ~bit != 0
+                else:
+                    consistent = any((value, y) in self.constraints[variable][otherVariable]
+                                     for y in bit_indices(assignment[otherVariable]))
+
+                if not consistent:
+                    break
+
             if consistent:
-                
-                # Because all CSPs are commutative, its enough to set the value of 
-                # only one single variable in each iteration
-                assignment[variable] = [value]
-                assignmentCopy = copy.deepcopy(assignment)
-                inferences = self.inference(assignmentCopy, self.get_all_arcs())
-
-                # Recursive call if the assignment is consistent
-                if inferences:
-                    result = self.backtrack(assignmentCopy)
-
-                    # Complete and consistent assignment, i.e. a solution 
+
+                # Because all CSPs are commutative, its enough to set the value of
+                # only one single variable in each iteration. The old domain
+                # masks are recorded on a trail so the trial can be undone
+                trail = [(variable, assignment[variable])]
+                assignment[variable] = bit
+
+                # Only the arcs pointing at the assigned variable can have
+                # lost support; inference enqueues the rest as it propagates
+                if self.kernel_data is not None:
+                    inferences = self.kernel_inference(assignment, variable, trail)
+                else:
+                    inferences = self.inference(assignment, deque(self.get_all_neighboring_arcs(variable)), trail)
+
+                # Recursive call if the assignment is consistent. Assigning
+                # the variable decided it, and inference reports how many
+                # more variables the propagation pinned down
+                if inferences is not None:
+                    result = self.backtrack(assignment, num_decided + 1 + inferences)
+
+                    # Complete and consistent assignment, i.e. a solution
                     if result:
+                        if self.memo is not None:
+                            self.memo[memo_key] = result
                         return result
 
-            assignment[variable].remove(value)
+                # The trial failed, so restore every domain it narrowed.
+                # The trail is walked backwards so that the oldest recorded
+                # mask for a variable is the one that ends up restored
+                for var, mask in reversed(trail):
+                    assignment[var] = mask
 
         global count_failures
         count_failures = count_failures + 1
 
-        return False  
-        
+        # Remember that this search state is unsatisfiable
+        if self.memo is not None and len(self.memo) < MEMO_LIMIT:
+            self.memo[memo_key] = False
+
+        return False
+
 
     def select_unassigned_variable(self, assignment):
         """
-        Returns one of the variables the assignment that have not yet been decided, i.e. whose list
-        of legal values has a length greater than one.
+        Returns the undecided variable with the fewest remaining legal values
+        (minimum-remaining-values heuristic), i.e. the variable most likely
+        to fail fast. Ties are broken by degree, preferring the variable
+        involved in the most constraints.
+        """
+        return min((variable for variable, values in assignment.items()
+                    if values.bit_count() > 1),
+                   key=lambda variable: (assignment[variable].bit_count(),
+                                         -len(self.constraints[variable])))
+
+
+    def build_kernel_data(self):
+        """
+        Build the flat data the ac3_neq kernel works on: integer ids for
+        the variables, a reusable domain buffer, and the constraint
+        graph in compressed sparse row form. Returns None unless every
+        arc is a NEQ constraint, in which case the generic inference
+        path must be used instead.
+        """
+        for i in self.constraint_kind:
+            for j in self.constraint_kind[i]:
+                if self.constraint_kind[i][j] is not ConstraintKind.NEQ:
+                    return None
+
+        var_id = {name: k for k, name in enumerate(self.variables)}
+        neighbors_ptr = [0]
+        neighbors_idx = []
+        for name in self.variables:
+            # Neighbors are sorted by id so the kernel walks the domain
+            # buffer in increasing address order
+            neighbors_idx.extend(sorted(var_id[other] for other in self.constraints[name]))
+            neighbors_ptr.append(len(neighbors_idx))
+
+        # Pack everything into contiguous typed arrays: uint16 domain
+        # bitmasks and the smallest integer type that fits the ids
+        num_variables = len(self.variables)
+        if np is not None:
+            id_type = np.uint8 if num_variables <= 0xFF else np.uint32
+            domains = np.zeros(num_variables, dtype=np.uint16)
+            neighbors_ptr = np.array(neighbors_ptr, dtype=np.uint32)
+            neighbors_idx = np.array(neighbors_idx, dtype=id_type)
+        else:
+            id_type = 'B' if num_variables <= 0xFF else 'L'
+            domains = array('H', [0] * num_variables)
+            neighbors_ptr = array('L', neighbors_ptr)
+            neighbors_idx = array(id_type, neighbors_idx)
+
+        return var_id, domains, neighbors_ptr, neighbors_idx
+
+
+    def kernel_inference(self, assignment, start_variable, trail):
+        """
+        Run the ac3_neq kernel on the current assignment. The domain
+        bitmasks are packed into the kernel's flat buffer, propagated
+        from start_variable (or from every decided variable when it is
+        None), and the narrowed domains are written back through the
+        trail. Returns the number of newly decided variables, or None
+        if some domain was wiped out, just like inference.
         """
-        for variable, values in assignment.items():
-            if len(values) > 1:
-                return variable
+        var_id, domains, neighbors_ptr, neighbors_idx = self.kernel_data
 
+        for k, name in enumerate(self.variables):
+            domains[k] = assignment[name]
 
-    def inference(self, assignment, queue):
+        start = -1 if start_variable is None else var_id[start_variable]
+        if not ac3_neq(domains, neighbors_ptr, neighbors_idx, start):
+            # The buffer is scratch space, so assignment is untouched
+            # and there is nothing extra to undo
+            return None
+
+        newly_decided = 0
+        for k, name in enumerate(self.variables):
+            new_domain = int(domains[k])
+            old_domain = assignment[name]
+            if new_domain != old_domain:
+                trail.append((name, old_domain))
+                assignment[name] = new_domain
+                if new_domain.bit_count() == 1:
+                    newly_decided += 1
+
+        return newly_decided
+
+
+    def inference(self, assignment, queue, trail):
         """AC-3 algorithm.
 
-        Achieves binary arc consistency for every variable.
+        Achieves binary arc consistency for every variable. Every domain
+        mask that gets narrowed is recorded on the trail, so the caller
+        can undo the propagation if the search backtracks. Returns the
+        number of variables the propagation narrowed down to a single
+        value, or None if some domain was wiped out.
         """
-        
-        while queue: # Queue of arcs 
-            (i, j) = queue.pop(0) # Remove first
 
-            if self.revise(assignment, i, j):
+        # Companion set of the arcs currently in the queue, so the same
+        # arc is never enqueued (and revised) twice
+        queued = set(queue)
+        newly_decided = 0
+
+        while queue: # Deque of arcs
+            arc = (i, j) = queue.popleft() # Remove first
+            queued.discard(arc)
+
+            if self.revise(assignment, i, j, trail):
 
                 # If there is no possible assignment for variable i
-                if len(assignment[i]) == 0:
-                    return False
-        
+                if assignment[i] == 0:
+                    return None
+
+                # A revision that leaves a single bit has decided the
+                # variable, since revise only ever narrows the domain
+                if assignment[i].bit_count() == 1:
+                    newly_decided += 1
+
                 # Add arcs to adjacent nodes to queue, excluding variable j
                 neighboring_arcs = self.get_all_neighboring_arcs(i)
                 for k in neighboring_arcs:
-                    if k[0] != j:
+                    if k[0] != j and k not in queued:
                         queue.append(k)
- 
-        return True
+                        queued.add(k)
+
+        return newly_decided
 
             
-    def revise(self, assignment, i, j):
+    def revise(self, assignment, i, j, trail):
         """
         assignment is the current partial assignment, that contains
-        the lists of legal values for each undecided variable. i and
+        the domain bitmasks for each undecided variable. i and
         j specifies the arc that should be visited. If a value is
         found in variable i's domain that doesn't satisfy the constraint
-        between i and j, the value is deleted from i's list of
-        legal values in assignment.
+        between i and j, the value's bit is cleared from i's domain
+        mask in assignment, and the old mask is recorded on the trail.
         """
-        revised = False
-
-        for x in assignment[i]:
-
-            # If no value y in the domain of j allows (x,y) to satisfy the 
-            # constraint between i and j, x is deleted from i's assignment list
-            satisfied = False
-            for y in assignment[j]:
-
-                if (x,y) in self.constraints[i][j]:
-                    satisfied = True
-                    break
-
-            # Returns True if revised such that the inference function can
-            # propagate the changes done in the assignment         
-            if not satisfied:
-                assignment[i].remove(x)
-                revised = True
-        
-        return revised
+        domain_i = assignment[i]
+        domain_j = assignment[j]
+
+        if self.constraint_kind[i][j] is ConstraintKind.NEQ:
+            # Only a decided neighbor can rule out a value; in that case
+            # its single remaining value is masked out of i's domain
+            if domain_j.bit_count() == 1:
+                new_domain = domain_i & ~domain_j
+            else:
+                new_domain = domain_i
+        elif domain_j & (domain_j - 1) == 0:
+            # Most revisions happen right after a neighbor was decided,
+            # so a single lookup per value of i suffices
+            pairs = self.constraints[i][j]
+            y = domain_j.bit_length() - 1
+            new_domain = 0
+
+            for x in bit_indices(domain_i):
+                if (x, y) in pairs:
+                    new_domain |= 1 << x
+        else:
+            pairs = self.constraints[i][j]
+            new_domain = 0
+
+            for x in bit_indices(domain_i):
+
+                # If no value y in the domain of j allows (x,y) to satisfy the
+                # constraint between i and j, x's bit is left out of i's domain
+                if any((x, y) in pairs for y in bit_indices(domain_j)):
+                    new_domain |= 1 << x
+
+        # The surviving values are collected into a fresh mask and the
+        # domain is replaced in one assignment, rather than removing
+        # unsupported values from it one at a time.
+        # Returns True if revised such that the inference function can
+        # propagate the changes done in the assignment
+        if new_domain != domain_i:
+            trail.append((i, domain_i))
+            assignment[i] = new_domain
+            return True
+
+        return False
 
 
 def create_map_coloring_csp():
@@ -263,14 +584,17 @@ def create_sudoku_csp(filename):
     current directory.
     """
     csp = CSP()
-    board = list(map(lambda x: x.strip(), open(filename, 'r')))
+    with open(filename) as f:
+        board = [line.rstrip() for line in f]
 
     for row in range(9):
         for col in range(9):
-            if board[row][col] == '0':
-                csp.add_variable('%d-%d' % (row, col), list(map(str, range(1, 10))))
-            else:
-                csp.add_variable('%d-%d' % (row, col), [board[row][col]])
+            # Every cell uses the same value ordering, so that equal
+            # value indices mean equal digits across the board
+            csp.add_variable('%d-%d' % (row, col), SUDOKU_DIGITS)
+            if board[row][col] != '0':
+                # Narrow a given cell down to its single digit
+                csp.domains['%d-%d' % (row, col)] = 1 << (int(board[row][col]) - 1)
 
     for row in range(9):
         csp.add_all_different_constraint(['%d-%d' % (row, col) for col in range(9)])